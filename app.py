@@ -1,13 +1,32 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import json
+import io
+import ijson
 import google.generativeai as genai
-import time
-from datetime import datetime, timedelta
+from google.generativeai import client as genai_client
+from google.api_core import exceptions as google_exceptions
+import asyncio
+import threading
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import as_completed
 import plotly.express as px
 
 st.set_page_config(page_title="V-Focus Audit", page_icon="☪️", layout="wide")
 
+MAX_CONCURRENT_REQUESTS = 5 # Stay well under the Gemini RPM quota
+RATE_LIMIT_RETRIES = 5
+RATE_LIMIT_BACKOFF = 0.25 # Seconds to wait after the first 429; doubles on each retry
+RATE_LIMIT_BACKOFF_MAX = 8
+FALLBACK_MODEL = "models/gemini-1.5-pro" # Supports system instructions and JSON schemas
+BATCH_SIZE = 50 # Titles per Gemini call; a whole audit fits in one prompt
+CLASSIFICATION_CACHE_SIZE = 100_000 # Max remembered (Niyyah, title) answers before LRU eviction
+CATEGORIES = ['Aligned', 'Neutral', 'Distraction']
+
 # --- SIDEBAR ---
 with st.sidebar:
     st.title("⚙️ Configuration")
@@ -16,124 +35,253 @@ with st.sidebar:
 
 st.title("☪️ V-Focus: Digital Soul Audit")
 
+# --- DATA LOADER ---
+@st.cache_data(show_spinner=False)
+def load_history(file_bytes):
+    """Parses a Takeout watch-history.json once per upload; reruns hit the cache."""
+    # Stream entries one at a time and keep only the two fields we use,
+    # so the full parsed history never sits in memory at once
+    titles, times = [], []
+    for entry in ijson.items(io.BytesIO(file_bytes), 'item'):
+        titles.append(entry.get('title'))
+        times.append(entry.get('time'))
+    # Clean the columns with Arrow compute kernels instead of per-row pandas string ops
+    title = pc.replace_substring_regex(pa.array(titles, type=pa.string()), pattern="^Watched ", replacement="")
+    time = pa.array(times, type=pa.string())
+    # Drop empty entries and visits to removed videos (title is just a URL); missing values drop too
+    keep = pc.and_(pc.and_(pc.not_equal(title, ''), pc.not_equal(time, '')),
+                   pc.invert(pc.match_substring(title, "https://")))
+    table = pa.table({'Title': title, 'Time': time}).filter(keep)
+    # Rewatches repeat titles a lot; a dictionary column arrives in pandas as a categorical
+    table = table.set_column(0, 'Title', pc.dictionary_encode(table['Title']))
+    df = table.to_pandas()
+    # Unparseable timestamps become NaT and are dropped instead of failing the upload
+    df['Time'] = pd.to_datetime(df['Time'], format='ISO8601', utc=True, cache=True, errors='coerce')
+    df = df.dropna(subset=['Time'])
+    # Sort oldest -> newest once so later steps can slice instead of re-sorting
+    return df.sort_values(by='Time', ignore_index=True)
+
 # --- SMART MODEL SELECTOR ---
-def get_best_model():
-    """Asks Google which models are available and picks the best one."""
+@st.cache_resource
+def find_best_model(api_key):
+    """Asks Google which models are available and picks the best one (once per API key)."""
+    for m in genai.list_models():
+        if 'generateContent' in m.supported_generation_methods:
+            # Prefer Flash (Fast/Cheap)
+            if 'flash' in m.name:
+                return m.name
+    # Fallback to Pro if Flash not found
+    return FALLBACK_MODEL
+
+def get_best_model(api_key):
+    """Like find_best_model, but falls back when Google can't be reached (the fallback is not cached)."""
     try:
-        for m in genai.list_models():
-            if 'generateContent' in m.supported_generation_methods:
-                # Prefer Flash (Fast/Cheap)
-                if 'flash' in m.name:
-                    return m.name
-        # Fallback to Pro if Flash not found
-        return "models/gemini-pro"
-    except:
-        return "models/gemini-pro"
+        return find_best_model(api_key)
+    except Exception:
+        return FALLBACK_MODEL
 
-# --- CLASSIFIER ---
-def classify_batch(titles_list, niyyah_text, model):
-    prompt = f"""
+# --- AI CLIENT ---
+@st.cache_resource
+def get_event_loop():
+    """One long-lived event loop, so cached models keep their gRPC channel open between audits."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+@st.cache_resource
+def get_configure_lock():
+    """genai.configure sets one key for the whole process, so sessions must take turns using it."""
+    return threading.Lock()
+
+async def make_async_client():
+    """Creates an async client on the shared loop for whichever key is configured right now."""
+    return genai_client.get_default_generative_async_client()
+
+@st.cache_resource(ttl=3600, max_entries=32)
+def get_client(api_key):
+    """Configures Gemini once per API key; returns the model name and an async client bound to that key."""
+    with get_configure_lock():
+        genai.configure(api_key=api_key)
+        model_name = get_best_model(api_key)
+        # Create the client now; made lazily on the first call, it would pick up
+        # whichever key another session configured in the meantime
+        async_client = asyncio.run_coroutine_threadsafe(make_async_client(), get_event_loop()).result()
+    return model_name, async_client
+
+def get_model(api_key, niyyah_text):
+    """Builds the model for this Niyyah on top of the cached per-key client (cheap, so not cached)."""
+    model_name, async_client = get_client(api_key)
+    # The fixed instructions live in the system instruction, so each batch only sends its titles
+    system_instruction = f"""
     My Intention (Niyyah) is: {niyyah_text}.
-    Classify these video titles into exactly one of these 3 categories:
+    Classify each numbered video title I send into exactly one of these 3 categories:
     - 'Aligned'
     - 'Neutral'
     - 'Distraction'
     
-    TITLES: {json.dumps(titles_list)}
-    
-    RETURN ONLY a JSON list of strings. Example: ["Aligned", "Distraction"]
+    RETURN ONLY a JSON object mapping each title number to its category. Example: {{"1": "Aligned", "2": "Distraction"}}
     """
+    model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+    model._async_client = async_client
+    return model
+
+# --- CLASSIFIER ---
+def build_generation_config(count):
+    """Makes Gemini answer with JSON holding exactly one valid category per title number."""
+    numbers = [str(i) for i in range(1, count + 1)]
+    category = {"type": "STRING", "format": "enum", "enum": CATEGORIES}
+    return {
+        "response_mime_type": "application/json",
+        "response_schema": {"type": "OBJECT", "properties": {n: category for n in numbers}, "required": numbers},
+    }
+
+async def classify_batch_async(titles_list, model, semaphore):
+    prompt = "\n".join(f"{i}. {json.dumps(t)}" for i, t in enumerate(titles_list, start=1))
+    generation_config = build_generation_config(len(titles_list))
     try:
-        response = model.generate_content(prompt)
-        text = response.text
-        # Extract JSON list from text
-        start = text.find('[')
-        end = text.rfind(']') + 1
-        if start != -1 and end != -1:
-            clean_json = text[start:end]
-            return json.loads(clean_json)
-        else:
-            return ["Error"] * len(titles_list)
+        async with semaphore:
+            backoff = RATE_LIMIT_BACKOFF
+            for attempt in range(RATE_LIMIT_RETRIES):
+                try:
+                    response = await model.generate_content_async(prompt, generation_config=generation_config)
+                    break
+                except (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests):
+                    # Only back off when Google actually rate limits us
+                    if attempt == RATE_LIMIT_RETRIES - 1:
+                        raise
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, RATE_LIMIT_BACKOFF_MAX)
+        categories = json.loads(response.text)
+        # Match answers back to titles by number, not by position
+        return [categories.get(str(i), "Error") for i in range(1, len(titles_list) + 1)]
     except Exception as e:
         return [f"Error"] * len(titles_list)
 
-# --- MAIN APP ---
-uploaded_file = st.file_uploader("Upload JSON File", type="json")
+async def make_semaphore():
+    """Builds the request semaphore on the loop that uses it (before Python 3.10 it binds on creation)."""
+    return asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
-if uploaded_file:
-    # 1. LOAD DATA
-    try:
-        data = json.load(uploaded_file)
-        clean_data = []
-        for entry in data:
-            title = entry.get('title', '').replace("Watched ", "")
-            time_str = entry.get('time', '')
-            if title and time_str and "https://" not in title:
-                clean_data.append({'Title': title, 'Time': time_str})
-        
-        df = pd.DataFrame(clean_data)
-        df['Time'] = pd.to_datetime(df['Time'], format='ISO8601')
-        
-        # Metrics
-        now = df['Time'].max()
-        col1, col2 = st.columns(2)
-        col1.metric("Videos (Last 30 Days)", len(df[df['Time'] >= (now - timedelta(days=30))]))
-        col2.metric("Videos (Last 12 Months)", len(df[df['Time'] >= (now - timedelta(days=365))]))
+def classify_all(batches, model, progress_bar):
+    """Sends all batches to Gemini at once and returns their categories in batch order."""
+    loop = get_event_loop()
+    semaphore = asyncio.run_coroutine_threadsafe(make_semaphore(), loop).result()
+    futures = [
+        asyncio.run_coroutine_threadsafe(classify_batch_async(batch, model, semaphore), loop)
+        for batch in batches
+    ]
+    # Progress is updated from the script thread; Streamlit can't be called from the loop thread
+    for done, _ in enumerate(as_completed(futures), start=1):
+        progress_bar.progress(done / len(batches))
+    return [future.result() for future in futures]
 
-    except Exception as e:
-        st.error(f"Error parsing file: {e}")
-        st.stop()
+@st.cache_resource
+def get_classification_cache():
+    """LRU of categories Gemini already gave, keyed by (Niyyah hash, title); shared across reruns and sessions."""
+    # Sessions run on separate script threads, so every access goes through the lock
+    return OrderedDict(), threading.Lock()
 
-    st.divider()
+def classify_titles(titles, niyyah_text, model, progress_bar):
+    """Returns a category per title, only sending unique titles missing from the cache to Gemini."""
+    cache, lock = get_classification_cache()
+    niyyah_key = hashlib.sha256(niyyah_text.encode()).hexdigest()
+    found = {}
+    misses = []
+    # Rewatched videos only need to be classified once
+    with lock:
+        for t in dict.fromkeys(titles):
+            category = cache.get((niyyah_key, t))
+            if category is None:
+                misses.append(t)
+            else:
+                cache.move_to_end((niyyah_key, t)) # Mark as recently used
+                found[t] = category
 
-    # 2. RUN AUDIT
+    batches = [misses[i:i+BATCH_SIZE] for i in range(0, len(misses), BATCH_SIZE)]
+    for batch, categories in zip(batches, classify_all(batches, model, progress_bar)):
+        for t, c in zip(batch, categories):
+            found[t] = c
+            # Only remember real answers so errors are retried next time
+            if c in CATEGORIES:
+                with lock:
+                    cache[(niyyah_key, t)] = c
+                    cache.move_to_end((niyyah_key, t))
+                    if len(cache) > CLASSIFICATION_CACHE_SIZE:
+                        cache.popitem(last=False) # Evict the least recently used
+
+    progress_bar.progress(1.0)
+    return [found[t] for t in titles]
+
+# --- AUDIT ---
+@st.fragment
+def audit_section(df, api_key, user_niyyah):
+    """Clicking the audit button only reruns this section, not the upload and metrics above it."""
     if not api_key:
         st.warning("Please enter API Key to run audit.")
     else:
         if st.button("🚀 Audit My Last 20 Videos"):
             
-            # Setup AI
-            genai.configure(api_key=api_key)
-            
-            # AUTO-DETECT MODEL NAME
-            model_name = get_best_model()
-            st.info(f"Using AI Model: `{model_name}`") # User can see which model is used
-            model = genai.GenerativeModel(model_name)
+            # Setup AI (cached, auto-detects the model name)
+            model = get_model(api_key, user_niyyah)
+            st.info(f"Using AI Model: `{model.model_name}`") # User can see which model is used
             
             # Prepare Data
-            df_audit = df.sort_values(by='Time', ascending=False).head(20)
+            df_audit = df.iloc[-20:][::-1] # Newest first
             titles = df_audit['Title'].tolist()
             
-            results = []
             progress_bar = st.progress(0, text="Auditing...")
             
-            # Run Batch
-            batch_size = 5
-            for i in range(0, len(titles), batch_size):
-                batch = titles[i:i+batch_size]
-                categories = classify_batch(batch, user_niyyah, model)
-                
-                for t, c in zip(batch, categories):
-                    results.append({'Category': c, 'Title': t})
-                
-                progress_bar.progress(min((i + batch_size) / len(titles), 1.0))
-                time.sleep(1) # Safety delay
+            # Run Batches (cached titles are skipped; a single call unless the audit outgrows BATCH_SIZE)
+            categories = classify_titles(titles, user_niyyah, model, progress_bar)
+            results = [{'Category': c, 'Title': t} for t, c in zip(titles, categories)]
 
             # Visualization
             res_df = pd.DataFrame(results)
+            # Anything the AI returned outside CATEGORIES is shown as "Error"
+            category = res_df['Category']
+            res_df['Category'] = category.where(category.isin(CATEGORIES), "Error").astype(pd.CategoricalDtype(CATEGORIES + ["Error"]))
             
             # Filter for valid categories
-            valid_df = res_df[res_df['Category'].isin(['Aligned', 'Neutral', 'Distraction'])]
+            valid_df = res_df[res_df['Category'] != "Error"]
             
             if not valid_df.empty:
                 st.subheader("Results")
-                fig = px.pie(valid_df, names='Category', hole=0.4, 
-                             color='Category',
+                # Pre-aggregate so the chart ships 3 numbers to the browser, not every row
+                counts = valid_df['Category'].value_counts()
+                counts = counts[counts > 0] # Categorical counts include unused categories
+                names = counts.index.tolist()
+                fig = px.pie(values=counts.to_numpy(), names=names, hole=0.4, 
+                             color=names,
                              color_discrete_map={'Aligned':'#00CC96', 'Neutral':'#AB63FA', 'Distraction':'#EF553B'})
                 st.plotly_chart(fig)
                 
                 st.write("### Audit Log")
-                st.dataframe(res_df)
+                st.dataframe(res_df, use_container_width=True, hide_index=True)
             else:
                 st.error("The AI returned errors. It might be overloaded. Try again in 1 minute.")
-                st.write("Debug info:", res_df)
\ No newline at end of file
+                st.write("Debug info:", res_df)
+
+# --- MAIN APP ---
+uploaded_file = st.file_uploader("Upload JSON File", type="json")
+
+if uploaded_file:
+    # 1. LOAD DATA
+    try:
+        df = load_history(uploaded_file.getvalue())
+        
+        # Metrics
+        times = df['Time'].to_numpy(dtype='datetime64[ns]') # Already sorted
+        now = times[-1]
+        cutoffs = [now - np.timedelta64(30, 'D'), now - np.timedelta64(365, 'D')]
+        idx30, idx365 = np.searchsorted(times, cutoffs)
+        col1, col2 = st.columns(2)
+        col1.metric("Videos (Last 30 Days)", len(times) - int(idx30))
+        col2.metric("Videos (Last 12 Months)", len(times) - int(idx365))
+
+    except Exception as e:
+        st.error(f"Error parsing file: {e}")
+        st.stop()
+
+    st.divider()
+
+    # 2. RUN AUDIT
+    audit_section(df, api_key, user_niyyah)